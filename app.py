@@ -1,25 +1,55 @@
 import streamlit as st
 import os
-import google.generativeai as genai
+import re
+import time
+import random
+from contextlib import closing
 from dotenv import load_dotenv
 
-# Load environment variables
-load_dotenv()
-
 # Main configuration
 APP_TITLE = "AI Powered Q&A Chatbot with Gemini"
 APP_DESCRIPTION = "Ask me anything and I'll do my best to answer your questions using Google's Gemini model!"
 APP_ICON = "🤖"
 
-# Configure the page
-st.set_page_config(
-    page_title=APP_TITLE,
-    page_icon=APP_ICON,
-    layout="wide"
-)
+# Gemini model and generation settings
+GEMINI_MODEL = "gemini-2.0-flash"
+GENERATION_CONFIG = {
+    "temperature": 0.7,
+    "top_p": 1,
+    "top_k": 1,
+    "max_output_tokens": 1000,
+}
 
-# Display header with a clean, professional style
-st.markdown(f"""
+# System prompt to request sources
+SYSTEM_PROMPT = """You are a helpful assistant that provides accurate information with sources.
+For factual information, always include relevant sources or citations at the end of your response.
+Format sources as a numbered list under a 'Sources:' heading."""
+
+# Minimum spacing between Gemini calls in a session and retry limit for quota errors
+MIN_REQUEST_INTERVAL = 0.5
+MAX_SEND_ATTEMPTS = 4
+
+# Number of past messages (user and model turns) sent to Gemini as context
+MAX_CONTEXT_MESSAGES = 40
+
+# Approximate token budget for that context (about four bytes per token)
+MAX_CONTEXT_TOKENS = 8000
+
+# Minimum seconds between placeholder repaints while streaming
+STREAM_RENDER_INTERVAL = 0.1
+
+# Assistant replies longer than this are collapsed in the history to a preview
+LARGE_MESSAGE_CHARS = 4000
+MESSAGE_PREVIEW_CHARS = 1500
+
+# Number of recent queries listed in the sidebar history
+MAX_HISTORY_DISPLAY = 20
+
+# Queries at least this long are truncated for display in the sidebar
+QUERY_DISPLAY_LENGTH = 40
+
+# Static HTML for the header and sidebar
+HEADER_HTML = f"""
 <div style="display: flex; align-items: center; margin-bottom: 20px;">
     <div style="font-size: 32px; margin-right: 10px;">{APP_ICON}</div>
     <div>
@@ -27,128 +57,260 @@ st.markdown(f"""
         <p style="color: #5A5A5A; font-size: 16px;">{APP_DESCRIPTION}</p>
     </div>
 </div>
-""", unsafe_allow_html=True)
+"""
+
+SIDEBAR_LOGO_HTML = """
+<div style="text-align: center; padding: 10px 0 20px 0;">
+    <div style="background-color: #0066B2; color: white; padding: 10px; border-radius: 5px; font-weight: bold;">
+        ENTERPRISE ASSISTANT
+    </div>
+</div>
+"""
+
+SIDEBAR_ABOUT_HTML = """
+<div style="background-color: #f7f9fc; padding: 15px; border-radius: 5px; border-left: 4px solid #0066B2;">
+    <p style="margin: 0; color: #444;">This chatbot uses Google's Gemini model to answer your questions.</p>
+    <p style="margin-top: 10px; color: #444;">Ask anything and get informative responses!</p>
+</div>
+"""
+
+SIDEBAR_FOOTER_HTML = "<div style='text-align: center; color: #888; font-size: 12px;'>Powered by Google Gemini & Streamlit</div>"
+
+# Static sidebar sections batched so each is sent as a single element
+SIDEBAR_TOP_MARKDOWN = "\n\n".join([SIDEBAR_LOGO_HTML.strip(), "### Chat Controls"])
+SIDEBAR_HISTORY_MARKDOWN = "\n\n".join(["---", "### 📜 Conversation History"])
+SIDEBAR_BOTTOM_MARKDOWN = "\n\n".join(["---", "### About", SIDEBAR_ABOUT_HTML.strip(), "---", SIDEBAR_FOOTER_HTML])
+
+# Markers that introduce a source section in model responses
+SOURCE_MARKER_PATTERN = re.compile(r"sources:|references:|citations:", re.IGNORECASE)
+
+# Words that show a prompt already asks for sources
+SOURCE_REQUEST_PATTERN = re.compile(r"source|reference|citation", re.IGNORECASE)
+
+# Configure the page
+st.set_page_config(
+    page_title=APP_TITLE,
+    page_icon=APP_ICON,
+    layout="wide"
+)
+
+# Display header with a clean, professional style
+st.markdown(HEADER_HTML, unsafe_allow_html=True)
 st.divider()
 
 # Initialize session state for messages
-if "messages" not in st.session_state:
-    st.session_state.messages = []
+st.session_state.setdefault("messages", [])
 
-# Configure Gemini API
-def configure_gemini():
-    """Configure the Gemini API client."""
-    api_key = os.getenv("GEMINI_API_KEY", "your_gemini_api_key_here")
-    
-    if api_key == "your_gemini_api_key_here":
-        st.error("Please set your Gemini API key in the .env file or as an environment variable.")
-        return None
+# Truncated user queries shown in the sidebar history, kept in step with messages
+st.session_state.setdefault("user_queries", [])
+
+# Load .env once per server process. Streamlit runs app.py as a fresh module on
+# every rerun, so the loaded flag is kept by st.cache_resource, not a global.
+@st.cache_resource(show_spinner=False)
+def load_env_file():
+    load_dotenv()
+    return True
+
+# Read the Gemini API key from the environment when a message is sent
+def get_gemini_api_key():
+    load_env_file()
+    return os.getenv("GEMINI_API_KEY", "")
+
+# Configure Gemini API and create the model once per API key.
+# A missing key is handled by the caller so it is never cached.
+@st.cache_resource(show_spinner=False)
+def get_gemini_model(api_key):
+    """Configure the Gemini API client and return a cached model instance."""
+    # Imported here so the first page render does not wait on the Gemini SDK
+    import google.generativeai as genai
     
     # Configure the Gemini API
     genai.configure(api_key=api_key)
-    return True
+    
+    # Create a model instance
+    return genai.GenerativeModel(
+        model_name=GEMINI_MODEL,
+        generation_config=GENERATION_CONFIG,
+        system_instruction=SYSTEM_PROMPT
+    )
 
 # Function to format response with highlighted sources
 def format_response_with_sources(response_text):
-    # Check for source sections
-    source_markers = ["sources:", "references:", "citations:"]
-    
-    # Find if any source marker exists in the response
-    source_index = -1
-    found_marker = None
+    # Every marker ends with a colon, so skip the regex when there is none
+    if ":" not in response_text:
+        return response_text, None
     
-    for marker in source_markers:
-        if marker in response_text.lower():
-            idx = response_text.lower().find(marker)
-            if source_index == -1 or idx < source_index:
-                source_index = idx
-                found_marker = marker
+    # Find the earliest source marker in a single case-insensitive scan
+    match = SOURCE_MARKER_PATTERN.search(response_text)
     
     # If no source section found, return the original text
-    if source_index == -1:
+    if match is None:
         return response_text, None
     
     # Split the response into main content and sources
+    source_index = match.start()
     main_content = response_text[:source_index].strip()
     sources_section = response_text[source_index:].strip()
     
     return main_content, sources_section
 
-# Function to get response from Gemini
+# Approximate token count from UTF-8 size, so non-ASCII text is not undercounted
+def estimate_tokens(text):
+    return len(text.encode("utf-8")) >> 2
+
+# Drop the oldest turns until the chat history fits the context limits
+def trim_chat_history(history):
+    history = history[-MAX_CONTEXT_MESSAGES:]
+    token_counts = [sum(estimate_tokens(part.text) for part in content.parts) for content in history]
+    total_tokens = sum(token_counts)
+    
+    # Remove user/model pairs so the history still starts on a user turn
+    start = 0
+    while total_tokens > MAX_CONTEXT_TOKENS and start < len(history):
+        total_tokens -= sum(token_counts[start:start + 2])
+        start += 2
+    
+    return history[start:]
+
+# Send a streaming message, debouncing rapid calls and backing off on rate-limit errors
+def send_with_rate_limit(chat, message):
+    from google.api_core.exceptions import ResourceExhausted
+    
+    elapsed = time.monotonic() - st.session_state.get("last_request_time", 0.0)
+    if elapsed < MIN_REQUEST_INTERVAL:
+        time.sleep(MIN_REQUEST_INTERVAL - elapsed)
+    
+    for attempt in range(MAX_SEND_ATTEMPTS):
+        st.session_state.last_request_time = time.monotonic()
+        try:
+            return chat.send_message(message, stream=True)
+        except ResourceExhausted:
+            if attempt == MAX_SEND_ATTEMPTS - 1:
+                raise
+            # Exponential backoff with jitter before retrying
+            time.sleep(2 ** attempt + random.random())
+
+# Function to stream the response from Gemini, yielding text chunks
 def get_gemini_response(prompt):
+    history_before = None
+    stream_finished = False
     try:
         # Check if Gemini is configured
-        if not configure_gemini():
-            return "Error: Gemini API key not set. Please set the GEMINI_API_KEY in your .env file."
+        api_key = get_gemini_api_key()
+        if not api_key or api_key == "your_gemini_api_key_here":
+            st.error("Please set your Gemini API key in the .env file or as an environment variable.")
+            yield "Error: Gemini API key not set. Please set the GEMINI_API_KEY in your .env file."
+            return
+        model = get_gemini_model(api_key)
         
-        # Get generation config and safety settings
-        generation_config = {
-            "temperature": 0.7,
-            "top_p": 1,
-            "top_k": 1,
-            "max_output_tokens": 1000,
-        }
-        
-        # Create a model instance
-        model = genai.GenerativeModel(
-            model_name="gemini-2.0-flash",
-            generation_config=generation_config
-        )
+        # Reuse the chat session so only the new turn is sent to the model
+        if "chat" not in st.session_state:
+            st.session_state.chat = model.start_chat(history=[])
+        chat = st.session_state.chat
         
-        # System prompt to request sources
-        system_prompt = """You are a helpful assistant that provides accurate information with sources.
-        For factual information, always include relevant sources or citations at the end of your response.
-        Format sources as a numbered list under a 'Sources:' heading."""
-        
-        # Prepare the chat history
-        chat_history = []
-        # Add system prompt if it's a new conversation
-        if not st.session_state.messages:
-            chat_history.append({"role": "model", "parts": [system_prompt]})
-            
-        for msg in st.session_state.messages:
-            if msg["role"] == "user":
-                chat_history.append({"role": "user", "parts": [msg["content"]]})
-            else:
-                chat_history.append({"role": "model", "parts": [msg["content"]]})
-        
-        # Start a chat session
-        chat = model.start_chat(history=chat_history)
+        # Keep the context bounded to the most recent turns before sending
+        history = chat.history
+        trimmed_history = trim_chat_history(history)
+        if len(trimmed_history) < len(history):
+            chat.history = trimmed_history
         
         # Generate a response - add request for source information
         enhanced_prompt = prompt
-        if "source" not in prompt.lower() and "reference" not in prompt.lower() and "citation" not in prompt.lower():
+        if not SOURCE_REQUEST_PATTERN.search(prompt):
             enhanced_prompt = f"{prompt}\n\nPlease include sources or citations for your information."
         
-        response = chat.send_message(enhanced_prompt)
+        # Copy the committed turns so an unfinished stream can be rolled back
+        history_before = list(chat.history)
+        response = send_with_rate_limit(chat, enhanced_prompt)
         
-        # Ensure we have a text response
-        if hasattr(response, 'text'):
-            return response.text
-        elif isinstance(response, str):
-            return response
-        else:
-            return str(response)
+        # Yield text as each chunk arrives
+        for chunk in response:
+            yield chunk.text
+        
+        # Commit the turn now; this raises if the reply was blocked or cut short
+        chat.history
+        stream_finished = True
         
     except Exception as e:
-        return f"Error: {str(e)}"
+        # Keep the error apart from any partial reply already streamed
+        yield f"\n\nError: {str(e)}"
+    
+    finally:
+        # Also runs on GeneratorExit when a rerun stops the stream part-way, so
+        # the next turn never reads the history of an unfinished reply
+        if history_before is not None and not stream_finished:
+            chat.history = history_before
+
+# Truncate long queries for display in the sidebar history
+def truncate_query(query):
+    if len(query) < QUERY_DISPLAY_LENGTH:
+        return query
+    return query[:QUERY_DISPLAY_LENGTH - 3] + "..."
+
+# Callback for the sidebar history selectbox
+def show_history_query():
+    index = st.session_state.history_choice
+    if index is not None:
+        # In a real app, you'd implement logic to highlight or scroll to this conversation
+        st.toast(f"Showing query: {st.session_state.user_queries[index]}")
+
+# Track the code fence a line opens or closes
+def toggle_code_fence(fence, line):
+    stripped = line.lstrip()
+    if fence is None:
+        return stripped[:3] if stripped.startswith(("```", "~~~")) else None
+    return None if stripped.startswith(fence) else fence
+
+# Cut a large reply to a preview at a line break outside any code fence
+def build_message_preview(text):
+    preview_end = 0
+    position = 0
+    fence = None
+    for line in text.splitlines(keepends=True):
+        position += len(line)
+        if position > MESSAGE_PREVIEW_CHARS:
+            break
+        fence = toggle_code_fence(fence, line)
+        if fence is None:
+            preview_end = position
+    if preview_end:
+        return text[:preview_end].rstrip()
+    
+    # No such line break, so cut at the last whitespace and close any open fence
+    cut = max(text.rfind(char, 0, MESSAGE_PREVIEW_CHARS) for char in " \t\n")
+    preview = text[:cut if cut > 0 else MESSAGE_PREVIEW_CHARS].rstrip()
+    fence = None
+    for line in preview.splitlines():
+        fence = toggle_code_fence(fence, line)
+    if fence is not None:
+        preview += "\n" + fence
+    return preview
+
+# Render an assistant reply with its sources in a collapsible section
+def render_assistant_message(main_content, sources_section, preview=None, key=None):
+    # Large replies show only a preview until the user asks for the full text
+    if preview is not None and not st.toggle("Show full message", key=f"full_message_{key}"):
+        st.markdown(preview + "\n\n…")
+    else:
+        st.markdown(main_content)
+    # Display sources if available in a collapsible section (hidden by default)
+    if sources_section:
+        with st.expander("📚 Sources", expanded=False):
+            with st.container(border=True):
+                st.markdown(sources_section)
+            st.caption("These sources are provided by the AI model and may require verification.")
 
 # Display chat history
-for message in st.session_state.messages:
+for index, message in enumerate(st.session_state.messages):
     with st.chat_message(message["role"], avatar="👤" if message["role"] == "user" else APP_ICON):
         if message["role"] == "assistant":
-            # Check if this message has sources
-            main_content, sources_section = format_response_with_sources(message["content"])
-            # Display main content
-            st.markdown(main_content)
-            # Display sources if available in a collapsible section
-            if sources_section:
-                with st.expander("📚 Sources", expanded=False):
-                    st.markdown(f"""
-                    <div style="background-color: #f7f9fc; padding: 15px; border-radius: 5px; border-left: 4px solid #0066B2;">
-                        {sources_section}
-                    </div>
-                    """, unsafe_allow_html=True)
-                    st.caption("These sources are provided by the AI model and may require verification.")
+            # Content, sources and preview were prepared when the message was stored
+            render_assistant_message(
+                message["main_content"],
+                message["sources_section"],
+                preview=message["preview"],
+                key=index
+            )
         else:
             # For user messages, just display the content
             st.markdown(message["content"])
@@ -157,6 +319,7 @@ for message in st.session_state.messages:
 if prompt := st.chat_input("Ask me anything..."):
     # Add user message to chat history
     st.session_state.messages.append({"role": "user", "content": prompt})
+    st.session_state.user_queries.append(truncate_query(prompt))
     
     # Display user message
     with st.chat_message("user", avatar="👤"):
@@ -165,82 +328,76 @@ if prompt := st.chat_input("Ask me anything..."):
     # Get and display assistant response
     with st.chat_message("assistant", avatar=APP_ICON):
         message_placeholder = st.empty()
+        # Shown until the first chunk arrives, which can wait on debounce or backoff
         message_placeholder.markdown("Thinking...")
         
-        response = get_gemini_response(prompt)
+        # Stream the response into the placeholder as it arrives
+        chunks = []
+        # Start at zero so the first chunk is shown as soon as it arrives
+        last_render = 0.0
+        # Close the stream as soon as a rerun interrupts it so the turn is rolled back
+        with closing(get_gemini_response(prompt)) as stream:
+            for text in stream:
+                chunks.append(text)
+                # Throttle repaints so long responses are not re-parsed on every chunk
+                if time.monotonic() - last_render >= STREAM_RENDER_INTERVAL:
+                    message_placeholder.markdown("".join(chunks))
+                    last_render = time.monotonic()
+        response = "".join(chunks)
         
         # Split response into main content and sources
         main_content, sources_section = format_response_with_sources(response)
         
-        # Display main content
-        message_placeholder.markdown(main_content)
-        
-        # Display sources if available in a collapsible section (hidden by default)
-        if sources_section:
-            with st.expander("📚 Sources", expanded=False):
-                st.markdown(f"""
-                <div style="background-color: #f7f9fc; padding: 15px; border-radius: 5px; border-left: 4px solid #0066B2;">
-                    {sources_section}
-                </div>
-                """, unsafe_allow_html=True)
-                st.caption("These sources are provided by the AI model and may require verification.")
+        # Replace the placeholder with the formatted response
+        with message_placeholder.container():
+            render_assistant_message(main_content, sources_section)
     
     # Add assistant response to chat history
-    st.session_state.messages.append({"role": "assistant", "content": response})
+    st.session_state.messages.append({
+        "role": "assistant",
+        "content": response,
+        "main_content": main_content,
+        "sources_section": sources_section,
+        "preview": build_message_preview(main_content) if len(main_content) > LARGE_MESSAGE_CHARS else None
+    })
 
-# Sidebar
-with st.sidebar:
-    # Add company logo placeholder
-    st.markdown("""
-    <div style="text-align: center; padding: 10px 0 20px 0;">
-        <div style="background-color: #0066B2; color: white; padding: 10px; border-radius: 5px; font-weight: bold;">
-            ENTERPRISE ASSISTANT
-        </div>
-    </div>
-    """, unsafe_allow_html=True)
-    
-    st.markdown("### Chat Controls")
+# Sidebar, run as a fragment so its widgets rerun only the sidebar
+@st.fragment
+def render_sidebar():
+    # Add company logo placeholder and controls heading
+    st.markdown(SIDEBAR_TOP_MARKDOWN, unsafe_allow_html=True)
     
     # Reset chat button with professional styling
     if st.button("Reset Conversation", type="primary", use_container_width=True):
         st.session_state.messages = []
-        st.rerun()
-        
-    st.divider()
+        st.session_state.user_queries = []
+        st.session_state.pop("chat", None)
+        st.session_state.pop("history_choice", None)
+        # Rerun the whole app, not just this fragment, to clear the chat
+        st.rerun(scope="app")
     
     # History section
-    st.markdown("### 📜 Conversation History")
-    
-    # Create a container for scrollable history
-    history_container = st.container(height=300, border=True)
-    
-    with history_container:
-        if len(st.session_state.messages) > 0:
-            # Display user queries in the history section
-            user_queries = [msg["content"] for msg in st.session_state.messages if msg["role"] == "user"]
-            
-            for i, query in enumerate(user_queries):
-                # Truncate long queries for display
-                display_query = query if len(query) < 40 else query[:37] + "..."
-                
-                # Create a clickable element that can be used to recall the conversation
-                if st.button(f"Q{i+1}: {display_query}", key=f"history_{i}", use_container_width=True):
-                    # Scroll to this part of the conversation in the main chat area
-                    # In a real app, you'd implement logic to highlight or scroll to this conversation
-                    st.toast(f"Showing query: {display_query}")
-        else:
-            st.info("No conversation history yet.")
-    
-    st.divider()
+    st.markdown(SIDEBAR_HISTORY_MARKDOWN)
     
-    # Info section
-    st.markdown("### About")
-    st.markdown("""
-    <div style="background-color: #f7f9fc; padding: 15px; border-radius: 5px; border-left: 4px solid #0066B2;">
-        <p style="margin: 0; color: #444;">This chatbot uses Google's Gemini model to answer your questions.</p>
-        <p style="margin-top: 10px; color: #444;">Ask anything and get informative responses!</p>
-    </div>
-    """, unsafe_allow_html=True)
+    user_queries = st.session_state.user_queries
+    if user_queries:
+        # A single selectbox keeps the widget count constant as history grows,
+        # listing only the most recent queries
+        st.selectbox(
+            "Past queries",
+            options=range(max(0, len(user_queries) - MAX_HISTORY_DISPLAY), len(user_queries)),
+            format_func=lambda i: f"Q{i+1}: {user_queries[i]}",
+            index=None,
+            placeholder="Select a past query",
+            key="history_choice",
+            on_change=show_history_query,
+            label_visibility="collapsed"
+        )
+    else:
+        st.info("No conversation history yet.")
     
-    st.divider()
-    st.markdown("<div style='text-align: center; color: #888; font-size: 12px;'>Powered by Google Gemini & Streamlit</div>", unsafe_allow_html=True) 
\ No newline at end of file
+    # Info section and footer
+    st.markdown(SIDEBAR_BOTTOM_MARKDOWN, unsafe_allow_html=True)
+
+with st.sidebar:
+    render_sidebar()
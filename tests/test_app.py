@@ -0,0 +1,99 @@
+import pytest
+import google.generativeai as genai
+from google.generativeai import protos
+from google.generativeai.types import generation_types
+
+import app
+
+
+# Stands in for GenerativeModel, streaming canned replies through the real SDK types
+class FakeModel:
+    def __init__(self, replies):
+        self.replies = list(replies)
+        self.requests = []
+
+    def _get_tools_lib(self, tools):
+        return None
+
+    def generate_content(self, contents, **kwargs):
+        self.requests.append(list(contents))
+        chunks = self.replies.pop(0)
+        return generation_types.GenerateContentResponse.from_iterator(
+            iter([make_chunk(text, finished=index == len(chunks) - 1) for index, text in enumerate(chunks)])
+        )
+
+
+def make_chunk(text, finished):
+    candidate = protos.Candidate(content=protos.Content(role="model", parts=[protos.Part(text=text)]))
+    if finished:
+        candidate.finish_reason = protos.Candidate.FinishReason.STOP
+    return protos.GenerateContentResponse(candidates=[candidate])
+
+
+@pytest.fixture
+def fake_model(monkeypatch):
+    model = FakeModel([["Partial ", "reply"], ["Second ", "reply"]])
+    app.st.session_state.clear()
+    app.st.session_state.chat = genai.ChatSession(model)
+    monkeypatch.setattr(app, "get_gemini_api_key", lambda: "test-key")
+    monkeypatch.setattr(app, "MIN_REQUEST_INTERVAL", 0)
+    yield model
+    app.st.session_state.clear()
+
+
+def test_interrupted_stream_does_not_break_next_turn(fake_model):
+    stream = app.get_gemini_response("First question")
+    assert next(stream) == "Partial "
+    # A rerun closes the generator while the reply is still streaming
+    stream.close()
+
+    reply = "".join(app.get_gemini_response("Second question"))
+
+    assert reply == "Second reply"
+    # Only the second turn reached the model and was kept in the history
+    assert len(fake_model.requests[1]) == 1
+    history = app.st.session_state.chat.history
+    assert [content.role for content in history] == ["user", "model"]
+    assert history[1].parts[0].text == "Second reply"
+
+
+def test_finished_stream_is_kept_in_history(fake_model):
+    assert "".join(app.get_gemini_response("First question")) == "Partial reply"
+    assert "".join(app.get_gemini_response("Second question")) == "Second reply"
+
+    assert len(fake_model.requests[1]) == 3
+    assert len(app.st.session_state.chat.history) == 4
+
+
+def test_preview_cuts_at_line_break_outside_fence():
+    text = "Intro line\n```python\n" + "x = 1\n" * 400 + "```\nMore text\n"
+
+    assert app.build_message_preview(text) == "Intro line"
+
+
+def test_preview_without_line_breaks_cuts_at_whitespace():
+    preview = app.build_message_preview("word " * 1000)
+
+    assert preview
+    assert len(preview) <= app.MESSAGE_PREVIEW_CHARS
+    assert preview.endswith("word")
+
+
+def test_preview_of_leading_code_block_closes_the_fence():
+    text = "```python\n" + "value = 1\n" * 400 + "```\nDone\n"
+
+    preview = app.build_message_preview(text)
+
+    assert preview.startswith("```python\nvalue = 1")
+    assert preview.endswith("\n```")
+
+
+def test_env_file_is_loaded_once(monkeypatch):
+    calls = []
+    monkeypatch.setattr(app, "load_dotenv", lambda: calls.append(True))
+    monkeypatch.setenv("GEMINI_API_KEY", "test-key")
+    app.load_env_file.clear()
+
+    assert app.get_gemini_api_key() == "test-key"
+    assert app.get_gemini_api_key() == "test-key"
+    assert len(calls) == 1